@@ -8,10 +8,14 @@ and metrics configurations.
 import json
 import logging
 import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Body
 from fastapi.responses import StreamingResponse
-from patterns.debate import DebateOrchestrator
-from patterns.debate_ai_foundry import DebateOrchestrator as DebateOrchestratorAiFoundry
+from patterns.debate import get_orchestrator, close_orchestrator
+from patterns.debate_ai_foundry import (
+    get_orchestrator as get_orchestrator_ai_foundry,
+    close_orchestrator as close_orchestrator_ai_foundry,
+)
 from utils.util import load_dotenv_from_azd, set_up_tracing, set_up_metrics, set_up_logging
 
 load_dotenv_from_azd()
@@ -27,8 +31,21 @@ logger = logging.getLogger(__name__)
 logging.getLogger('azure.core.pipeline.policies.http_logging_policy').setLevel(logging.WARNING)
 logging.getLogger('azure.monitor.opentelemetry.exporter.export').setLevel(logging.WARNING)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Starts the process-wide orchestrators on startup and closes their connections on shutdown.
+    
+    The AI Foundry orchestrator provisions its Critic agent when started, so it is 
+    started on its first request instead of at application startup.
+    """
+    await get_orchestrator()
+    yield
+    await close_orchestrator()
+    await close_orchestrator_ai_foundry()
+
 # Initialize FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 logger.info("Diagnostics: %s", os.getenv('SEMANTICKERNEL_EXPERIMENTAL_GENAI_ENABLE_OTEL_DIAGNOSTICS'))
 
@@ -45,8 +62,10 @@ async def http_blog(request_body: dict = Body(...)):
               'ai_foundry_sk_mix' for 1 Azure AI agent and 1 SK agent. Defaults to 'sk'.
     
     Returns:
-        StreamingResponse: A streaming response.
-        Chunk can be be either a string or contain JSON. 
+        StreamingResponse: A streaming response, one chunk per line.
+        "event: turn" marks a completed agent turn.
+        "data: " is followed by a JSON encoded string with the text of that turn.
+        Other chunks can be be either a string or contain JSON. 
         If the chunk is a string it is a status update. 
         JSON will contain the generated blog post content.
     """
@@ -59,10 +78,10 @@ async def http_blog(request_body: dict = Body(...)):
 
     # Select orchestrator based on request parameter
     if orchestrator_type == 'sk':
-        orchestrator = DebateOrchestrator()
+        orchestrator = await get_orchestrator()
         logger.info('Using DebateOrchestrator (Two Semantic Kernel agents)')
     else:
-        orchestrator = DebateOrchestratorAiFoundry()
+        orchestrator = await get_orchestrator_ai_foundry()
         logger.info('Using DebateOrchestratorAiFoundry (One Semantic Kernel agent and one Azure AI Agent)')
 
     conversation_messages = []
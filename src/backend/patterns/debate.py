@@ -1,31 +1,41 @@
 import os
-import json
+import asyncio
 import logging
-from typing import ClassVar
+import time
+import hashlib
 import datetime
-from utils.util import describe_next_action
+import uuid
+from collections import OrderedDict
+from utils.util import MemoryCompactor, TurnDescriber, CompletionTerminationStrategy
 
 from semantic_kernel.kernel import Kernel
 from semantic_kernel.agents import AgentGroupChat
-from semantic_kernel.agents.strategies.termination.termination_strategy import TerminationStrategy
 from semantic_kernel.agents.strategies import KernelFunctionSelectionStrategy
 from semantic_kernel.connectors.ai.open_ai import AzureChatPromptExecutionSettings
 
+from semantic_kernel.contents.chat_history import ChatHistory
 from semantic_kernel.contents.chat_message_content import ChatMessageContent
 from semantic_kernel.contents.utils.author_role import AuthorRole
 from semantic_kernel.core_plugins.time_plugin import TimePlugin
-from semantic_kernel.functions import KernelPlugin, KernelFunctionFromPrompt, KernelArguments
+from semantic_kernel.functions import KernelPlugin, KernelFunctionFromMethod, kernel_function
 
 from semantic_kernel.connectors.ai.azure_ai_inference import AzureAIInferenceChatCompletion
 from azure.ai.inference.aio import ChatCompletionsClient
+from azure.core.pipeline.transport import AioHttpTransport
 from azure.identity.aio import DefaultAzureCredential
 
+import aiohttp
+import orjson
+
 from opentelemetry.trace import get_tracer
 
-from pydantic import Field
 from utils.util import create_agent_from_yaml
 
 
+# Only these conversation roles are passed on to the agents
+_ALLOWED_ROLES = frozenset(("assistant", "user"))
+
+
 # This pattern demonstrates how a debate between equally skilled models
 # can deliver an outcome that exceeds the capability of the model if 
 # the task is handled as a single request-response in its entirety. 
@@ -45,10 +55,10 @@ class DebateOrchestrator:
     # --------------------------------------------
     def __init__(self):
         """
-        Creates the DebateOrchestrator with necessary services and kernel configurations.
+        Creates the DebateOrchestrator with its configuration and execution settings.
         
-        Sets up Azure OpenAI connections for both executor and utility models, 
-        configures Semantic Kernel, and prepares execution settings for the agents.
+        Construction is cheap and does not open any connection. Call startup() once
+        before processing conversations - or use get_orchestrator() which does both.
         """
         
         self.logger = logging.getLogger(__name__)
@@ -57,54 +67,131 @@ class DebateOrchestrator:
 
         self.logger.info("Creating - %s", os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"))
 
-        endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-        api_version = os.getenv("AZURE_OPENAI_API_VERSION")
-        executor_deployment_name = os.getenv("EXECUTOR_AZURE_OPENAI_DEPLOYMENT_NAME")
-        utility_deployment_name = os.getenv("UTILITY_AZURE_OPENAI_DEPLOYMENT_NAME")
+        self.endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
+        self.api_version = os.getenv("AZURE_OPENAI_API_VERSION")
+        self.executor_deployment_name = os.getenv("EXECUTOR_AZURE_OPENAI_DEPLOYMENT_NAME")
+        self.utility_deployment_name = os.getenv("UTILITY_AZURE_OPENAI_DEPLOYMENT_NAME")
+        
+        self.settings_executor = AzureChatPromptExecutionSettings(service_id="executor", temperature=0)
+        self.settings_utility = AzureChatPromptExecutionSettings(service_id="utility", temperature=0)
+        
+        self.resourceGroup = os.getenv("AZURE_RESOURCE_GROUP")
+        
+        # Connections to the Azure OpenAI endpoint shared by the executor and utility services
+        self.pool_size = int(os.getenv("AZURE_OPENAI_POOL_SIZE", "16"))
+        
+        # Chat history beyond this many tokens is summarized before it is put into a prompt
+        self.memory_token_budget = int(os.getenv("MEMORY_TOKEN_BUDGET", "3000"))
+        
+        # Replies to identical conversations are replayed for this many seconds - 0 disables the cache
+        self.response_cache_ttl = int(os.getenv("RESPONSE_CACHE_TTL", "0"))
+        self.response_cache_size = 256
+        self._response_cache = OrderedDict()
+        
+        self.kernel = None
+
+    # --------------------------------------------
+    # Startup
+    # --------------------------------------------
+    async def startup(self):
+        """
+        Wires the credential, HTTP session, chat completion clients and kernel.
         
-        credential = DefaultAzureCredential()
+        Sets up Azure OpenAI connections for both executor and utility models 
+        and configures Semantic Kernel. Must run inside the event loop that serves requests.
+        """
+        
+        self.logger.info("Semantic Orchestrator Handler startup")
+        
+        # One credential (with its token cache) and one connection pool shared by both services
+        self._credential = DefaultAzureCredential()
+        # Both services call the same host, so the per-host limit matches the pool size
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.pool_size,
+                limit_per_host=self.pool_size,
+                ttl_dns_cache=300,
+                enable_cleanup_closed=True,
+                keepalive_timeout=120))
         
         # Multi model setup - a service is an LLM in SK terms
         # Executor - gpt-4o 
         # Utility  - gpt-4o-mini
+        self._executor_client = ChatCompletionsClient(
+                endpoint=f"{str(self.endpoint).strip('/')}/openai/deployments/{self.executor_deployment_name}",
+                api_version=self.api_version,
+                credential=self._credential,
+                credential_scopes=["https://cognitiveservices.azure.com/.default"],
+                transport=AioHttpTransport(session=self._session, session_owner=False),
+            )
         executor_service = AzureAIInferenceChatCompletion(
             ai_model_id="executor",
             service_id="executor",
-            client=ChatCompletionsClient(
-                endpoint=f"{str(endpoint).strip('/')}/openai/deployments/{executor_deployment_name}",
-                api_version=api_version,
-                credential=credential,
-                credential_scopes=["https://cognitiveservices.azure.com/.default"],
-            ))
+            client=self._executor_client)
         
+        self._utility_client = ChatCompletionsClient(
+                endpoint=f"{str(self.endpoint).strip('/')}/openai/deployments/{self.utility_deployment_name}",
+                api_version=self.api_version,
+                credential=self._credential,
+                credential_scopes=["https://cognitiveservices.azure.com/.default"],
+                transport=AioHttpTransport(session=self._session, session_owner=False),
+            )
         utility_service = AzureAIInferenceChatCompletion(
             ai_model_id="utility",
             service_id="utility",
-            client=ChatCompletionsClient(
-                endpoint=f"{str(endpoint).strip('/')}/openai/deployments/{utility_deployment_name}",
-                api_version=api_version,
-                credential=credential,
-                credential_scopes=["https://cognitiveservices.azure.com/.default"],
-            ))
+            client=self._utility_client)
         
         self.kernel = Kernel(
             services=[executor_service, utility_service],
             plugins=[
                 KernelPlugin.from_object(plugin_instance=TimePlugin(), plugin_name="time")
             ])
+
+        # Agents do not change between conversations - build them once per process
+        self._writer = create_agent_from_yaml(service_id="executor",
+                                              kernel=self.kernel,
+                                              definition_file_path="agents/writer.yaml")
+        self._critic = create_agent_from_yaml(service_id="executor",
+                                              kernel=self.kernel,
+                                              definition_file_path="agents/critic.yaml")
         
-        self.settings_executor = AzureChatPromptExecutionSettings(service_id="executor", temperature=0)
-        self.settings_utility = AzureChatPromptExecutionSettings(service_id="utility", temperature=0)
+        # The selection prompt only depends on the agents - compile it once
+        self._agent_definitions = "\n".join(f"{a.name}: {a.description}" for a in (self._writer, self._critic))
+        self._selection_function = self.create_selection_function(self._agent_definitions)
         
-        self.resourceGroup = os.getenv("AZURE_RESOURCE_GROUP")
+        # Cached replies are only valid for the agents and model that produced them
+        self._agents_version = hashlib.blake2b(orjson.dumps(
+            [self.executor_deployment_name] + [[a.name, a.description, a.instructions] for a in (self._writer, self._critic)]
+        ), digest_size=8).hexdigest()
+
+    # --------------------------------------------
+    # Shutdown
+    # --------------------------------------------
+    async def aclose(self):
+        """
+        Releases the shared HTTP session, chat completion clients and credential.
+        
+        Must be called once on application shutdown.
+        """
+        self.logger.info("Semantic Orchestrator Handler shutdown")
+        await self._executor_client.close()
+        await self._utility_client.close()
+        await self._session.close()
+        await self._credential.close()
 
     # --------------------------------------------
     # Create Agent Group Chat
     # --------------------------------------------
-    def create_agent_group_chat(self):
+    def create_agent_group_chat(self, turns):
         """
         Creates and configures an agent group chat with Writer and Critic agents.
         
+        The agents are built once in startup(); only the group chat and its 
+        strategies are created per conversation.
+        
+        Args:
+            turns: TurnDescriber of the conversation, shared with the termination strategy.
+        
         Returns:
             AgentGroupChat: A configured group chat with specialized agents, 
                            selection strategy and termination strategy.
@@ -112,20 +199,15 @@ class DebateOrchestrator:
         
         self.logger.debug("Creating chat")
         
-        writer = create_agent_from_yaml(service_id="executor",
-                                        kernel=self.kernel,
-                                        definition_file_path="agents/writer.yaml")
-        critic = create_agent_from_yaml(service_id="executor",
-                                        kernel=self.kernel,
-                                        definition_file_path="agents/critic.yaml")
-        agents=[writer, critic]
+        agents=[self._writer, self._critic]
 
         agent_group_chat = AgentGroupChat(
                 agents=agents,
-                selection_strategy=self.create_selection_strategy(agents, critic),
+                selection_strategy=self.create_selection_strategy(self._critic),
                 termination_strategy = self.create_termination_strategy(
-                                         agents=[critic],
-                                         maximum_iterations=6))
+                                         agents=[self._critic],
+                                         maximum_iterations=6,
+                                         turns=turns))
 
         return agent_group_chat
         
@@ -145,72 +227,162 @@ class DebateOrchestrator:
                                   representing the conversation history.
                                   
         Yields:
-            Status updates during processing and the final response in JSON format.
+            "event: turn" when an agent turn completes, followed by "data: <JSON string>" with 
+            the text of the turn, plain text status updates and the final response in JSON format.
         """
         
-        agent_group_chat = self.create_agent_group_chat()
+        # Identical conversations replay the cached status updates and final response
+        cache_key = self.conversation_key(conversation_messages) if self.response_cache_ttl > 0 else None
+        cached = self.get_cached_response(cache_key)
+        if cached is not None:
+            self.logger.info("Replaying cached response %s", cache_key)
+            for line in cached:
+                yield line
+            return
+        statuses = []
+        
+        # One utility call per turn describes the next action and extracts the
+        # CRITIC score - for both this loop and the termination strategy
+        turns = TurnDescriber(self.kernel, self.settings_utility)
+        agent_group_chat = self.create_agent_group_chat(turns)
        
         # Load chat history
-        chat_history = [
+        chat_history = (
             ChatMessageContent(
-                role=AuthorRole(d.get('role')),
+                role=AuthorRole(d['role']),
                 name=d.get('name'),
-                content=d.get('content')
-            ) for d in filter(lambda m: m['role'] in ("assistant", "user"), conversation_messages)
-        ]
+                content=d['content']
+            ) for d in conversation_messages if d['role'] in _ALLOWED_ROLES
+        )
 
-        await agent_group_chat.add_chat_messages(chat_history)
+        # add_chat_messages needs a sized list
+        await agent_group_chat.add_chat_messages(list(chat_history))
 
         tracer = get_tracer(__name__)
         
         # UNIQUE SESSION ID is a must for AI Foundry Tracing
-        current_time = datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S")
-        session_id = f"{user_id}-{current_time}"
+        session_id = f"{user_id}-{uuid.uuid4().hex}"
+        
+        last_writer = None
         
-        messages = []
+        # Next action descriptions run in the background while the next agent turn
+        # is generated. Completed ones are yielded in order as soon as possible.
+        pending_actions = []
         
-        with tracer.start_as_current_span(session_id):
-            yield "WRITER: Prepares the initial draft"
-            async for a in agent_group_chat.invoke():
-                self.logger.info("Agent: %s", a.to_dict())
-                messages.append(a.to_dict())
-                next_action = await describe_next_action(self.kernel, self.settings_utility, messages)
-                self.logger.info("%s", next_action)
-                # Returning plain text to indicate that it is a status update
-                yield f"{next_action}"
+        with tracer.start_as_current_span(session_id) as span:
+            span.set_attribute("start_time", datetime.datetime.now().isoformat())
+            statuses.append("WRITER: Prepares the initial draft")
+            yield statuses[-1]
+            try:
+                # Not invoke_stream(): semantic-kernel 1.27 does not record streamed turns in 
+                # the group chat history, so selection and termination would never see them.
+                # Every turn is sent to the client as soon as it completes instead.
+                async for a in agent_group_chat.invoke():
+                    # Function calls and results are not part of the debate
+                    if a.role != AuthorRole.ASSISTANT or not a.content:
+                        continue
+                    # to_dict() is costly for long messages - only build it when it is logged
+                    if self.logger.isEnabledFor(logging.INFO):
+                        self.logger.info("Agent: %s", a.to_dict())
+                    if a.name == "Writer":
+                        last_writer = a
+                    pending_actions.append(turns.describe(a))
+                    yield "event: turn"
+                    # Turn text is JSON encoded to keep it on a single line
+                    yield f"data: {orjson.dumps(a.content).decode()}"
+                    while pending_actions and pending_actions[0].done():
+                        next_action = pending_actions.pop(0).result()["next_action"]
+                        self.logger.info("%s", next_action)
+                        statuses.append(f"{next_action}")
+                        # Returning plain text to indicate that it is a status update
+                        yield f"{next_action}"
 
-        response = list(reversed([item async for item in agent_group_chat.get_chat_messages()]))
+                while pending_actions:
+                    next_action = (await pending_actions.pop(0))["next_action"]
+                    self.logger.info("%s", next_action)
+                    statuses.append(f"{next_action}")
+                    yield f"{next_action}"
+            finally:
+                for task in pending_actions:
+                    task.cancel()
 
+        if last_writer is None:
+            # Nothing to return or cache - the debate ended before the Writer answered
+            self.logger.error("Session %s ended without a Writer response", session_id)
+            yield orjson.dumps({"role": "assistant", "content": "The Writer did not produce a draft."}).decode()
+            return
+        
         # Last writer response
-        reply = [r for r in response if r.name == "Writer"][-1].to_dict()
+        reply = last_writer.to_dict()
         
         # Final message is formatted as JSON to indicate the final response
-        yield json.dumps(reply)
+        final = orjson.dumps(reply).decode()
+        self.cache_response(cache_key, statuses + [final])
+        yield final
+        
+    # --------------------------------------------
+    # Response Cache
+    # --------------------------------------------
+    def conversation_key(self, conversation_messages):
+        """
+        Hashes the messages passed on to the agents together with the agents version.
+        
+        Args:
+            conversation_messages: List of dictionaries with role, name and content.
+            
+        Returns:
+            str: Hex digest identifying the conversation.
+        """
+        messages = [m for m in conversation_messages if m['role'] in _ALLOWED_ROLES]
+        payload = orjson.dumps([self._agents_version, messages], option=orjson.OPT_SORT_KEYS)
+        return hashlib.blake2b(payload, digest_size=16).hexdigest()
+    
+    def get_cached_response(self, key):
+        """Returns the cached lines for the key, or None when missing or expired."""
+        if key is None:
+            return None
+        entry = self._response_cache.get(key)
+        if entry is None:
+            return None
+        expires, lines = entry
+        if expires < time.monotonic():
+            del self._response_cache[key]
+            return None
+        self._response_cache.move_to_end(key)
+        return lines
+    
+    def cache_response(self, key, lines):
+        """Stores the status updates and final response of a completed debate."""
+        if key is None:
+            return
+        self._response_cache[key] = (time.monotonic() + self.response_cache_ttl, lines)
+        self._response_cache.move_to_end(key)
+        if len(self._response_cache) > self.response_cache_size:
+            self._response_cache.popitem(last=False)
         
     # --------------------------------------------
     # Speaker Selection Strategy
     # --------------------------------------------
     # Using executor model since we need to process context - cognitive task
-    def create_selection_strategy(self, agents, default_agent):
+    def create_selection_function(self, definitions):
         """
-        Creates a strategy to determine which agent speaks next in the conversation.
+        Creates the function that picks the next speaker.
         
-        Uses the executor model to analyze conversation context and select the most 
-        appropriate next speaker based on the conversation history.
+        The instructions only depend on the agents, so the function is built once in startup().
         
         Args:
-            agents: List of available agents in the conversation.
-            default_agent: The fallback agent to use if selection fails.
+            definitions: "name: description" lines of the available agents.
             
         Returns:
-            KernelFunctionSelectionStrategy: A strategy for selecting the next speaker.
+            KernelFunctionFromMethod: The SpeakerSelector function.
         """
-        definitions = "\n".join([f"{agent.name}: {agent.description}" for agent in agents])
-        
-        selection_function = KernelFunctionFromPrompt(
-                function_name="SpeakerSelector",
-                prompt_execution_settings=self.settings_executor,
-                prompt=fr"""
+        # The static instructions go into the system message and the history into a
+        # separate user message, so the prompt prefix stays identical across turns 
+        # and can be served from the prompt cache.
+        # The chat history is built directly rather than through a <message> prompt
+        # template: the selection strategy passes the history as a list, which the 
+        # template does not escape, so "&" or "<" in a draft would break the split.
+        instructions = f"""
                     You are the next speaker selector.
 
                     - You MUST return ONLY agent name from the list of available agents below.
@@ -223,11 +395,31 @@ class DebateOrchestrator:
 # AVAILABLE AGENTS
 
 {definitions}
+"""
+        service = self.kernel.get_service("executor")
+        settings = self.settings_executor
+
+        @kernel_function(name="SpeakerSelector")
+        async def select_speaker(history: list) -> list[ChatMessageContent]:
+            chat = ChatHistory(system_message=instructions)
+            chat.add_user_message(f"# CHAT HISTORY\n\n{history}")
+            return await service.get_chat_message_contents(chat_history=chat, settings=settings)
 
-# CHAT HISTORY
+        return KernelFunctionFromMethod(method=select_speaker)
 
-{{{{$history}}}}
-""")
+    def create_selection_strategy(self, default_agent):
+        """
+        Creates a strategy to determine which agent speaks next in the conversation.
+        
+        Uses the executor model to analyze conversation context and select the most 
+        appropriate next speaker based on the conversation history.
+        
+        Args:
+            default_agent: The fallback agent to use if selection fails.
+            
+        Returns:
+            KernelFunctionSelectionStrategy: A strategy for selecting the next speaker.
+        """
 
         # Could be lambda. Keeping as function for clarity
         def parse_selection_output(output):
@@ -238,15 +430,34 @@ class DebateOrchestrator:
 
         return KernelFunctionSelectionStrategy(
                     kernel=self.kernel,
-                    function=selection_function,
+                    function=self._selection_function,
                     result_parser=parse_selection_output,
                     agent_variable_name="agents",
-                    history_variable_name="history")
+                    history_variable_name="history",
+                    history_reducer=self.create_memory_compactor())
+
+    # --------------------------------------------
+    # Memory
+    # --------------------------------------------
+    # Using UTILITY model - summarization of earlier turns is a simple task
+    def create_memory_compactor(self):
+        """
+        Creates a compactor that keeps a conversation within the memory token budget.
+        
+        Each compactor tracks a single growing history, so a new one is needed per 
+        conversation and per consumer.
+        
+        Returns:
+            MemoryCompactor: Summarizes the middle of the history once it exceeds the budget.
+        """
+        return MemoryCompactor(kernel=self.kernel,
+                               settings=self.settings_utility,
+                               token_budget=self.memory_token_budget)
 
     # --------------------------------------------
     # Termination Strategy
     # --------------------------------------------
-    def create_termination_strategy(self, agents, maximum_iterations):
+    def create_termination_strategy(self, agents, maximum_iterations, turns):
         """
         Creates a strategy to determine when the debate should end.
         
@@ -256,49 +467,44 @@ class DebateOrchestrator:
         Args:
             agents: List of agents that can trigger termination evaluation.
             maximum_iterations: Maximum number of conversation turns before forced termination.
+            turns: TurnDescriber providing the score when the evaluation has no unambiguous "N/10" score.
             
         Returns:
             CompletionTerminationStrategy: A strategy for determining when to end the debate.
         """
+        return CompletionTerminationStrategy(agents=agents,
+                                             maximum_iterations=maximum_iterations,
+                                             turns=turns)
 
-        # Using UTILITY model - the task is simple - evaluation score extraction
-        class CompletionTerminationStrategy(TerminationStrategy):
-            logger: ClassVar[logging.Logger] = logging.getLogger(__name__)
-            
-            iteration: int = Field(default=0)
-            kernel: ClassVar[Kernel] = self.kernel
-            
-            termination_function: ClassVar[KernelFunctionFromPrompt] = KernelFunctionFromPrompt(
-                function_name="TerminationEvaluator",
-                prompt_execution_settings=self.settings_utility,
-                prompt=fr"""
-                    You are a data extraction assistant.
-                    Check the provided evaluation and return the evalutation score.
-                    It MUST be a single number only, for example - for 6/10 return 6.
-                    {{{{$evaluation}}}}
-                """)
-
-            async def should_agent_terminate(self, agent, history):
-                """Terminate if the evaluation score > the passing score."""
-                
-                self.iteration += 1
-                self.logger.info(f"Iteration: {self.iteration} of {self.maximum_iterations}")
-                
-                arguments = KernelArguments()
-                arguments["evaluation"] = history[-1].content 
-
-                res_val = await self.kernel.invoke(function=self.termination_function, arguments=arguments)
-                self.logger.info(f"Critic Evaluation: {res_val}")
-
-                try:
-                    # 9 is a relatively high score. Set to 8 for stable result.
-                    should_terminate = float(str(res_val)) >= 8.0        
-                except ValueError:
-                    self.logger.error(f"Should terminate error: {ValueError}")
-                    should_terminate = False
-                    
-                self.logger.info(f"Should terminate: {should_terminate}")
-                return should_terminate
 
-        return CompletionTerminationStrategy(agents=agents,
-                                             maximum_iterations=maximum_iterations)
\ No newline at end of file
+# --------------------------------------------
+# Process-wide orchestrator
+# --------------------------------------------
+_orchestrator = None
+_orchestrator_lock = asyncio.Lock()
+
+async def get_orchestrator():
+    """
+    Returns the process-wide DebateOrchestrator, creating and starting it on first use.
+    
+    The kernel, services and settings do not change between requests, so one
+    instance is shared by all of them.
+    """
+    global _orchestrator
+    if _orchestrator is None:
+        async with _orchestrator_lock:
+            if _orchestrator is None:
+                orchestrator = DebateOrchestrator()
+                await orchestrator.startup()
+                _orchestrator = orchestrator
+    return _orchestrator
+
+async def close_orchestrator():
+    """
+    Closes the process-wide DebateOrchestrator if it was started.
+    """
+    global _orchestrator
+    async with _orchestrator_lock:
+        if _orchestrator is not None:
+            await _orchestrator.aclose()
+            _orchestrator = None
@@ -6,12 +6,20 @@ This module provides helper functions for:
 - OpenTelemetry setup for observability (tracing, metrics, and logging)
 - Agent creation from YAML definitions
 - Workflow utilities for agent interactions
+- Token-budgeted chat history compaction
+- Debate termination on the CRITIC score
 """
 
 from io import StringIO
 from subprocess import run, PIPE
+from collections import OrderedDict
 import os
+import re
+import json
+import asyncio
+import hashlib
 import logging
+from typing import ClassVar
 from dotenv import load_dotenv
 import yaml
 
@@ -53,6 +61,13 @@ from semantic_kernel.connectors.ai.open_ai import AzureChatPromptExecutionSettin
 
 from semantic_kernel.functions import KernelArguments
 from semantic_kernel.agents import ChatCompletionAgent, AzureAIAgent, AzureAIAgentSettings
+from semantic_kernel.agents.strategies.termination.termination_strategy import TerminationStrategy
+from semantic_kernel.kernel import Kernel
+from semantic_kernel.connectors.ai.prompt_execution_settings import PromptExecutionSettings
+from semantic_kernel.contents.chat_message_content import ChatMessageContent
+from semantic_kernel.contents.history_reducer.chat_history_reducer import ChatHistoryReducer
+from semantic_kernel.contents.utils.author_role import AuthorRole
+from pydantic import Field
 
 def load_dotenv_from_azd():
     """
@@ -221,7 +236,7 @@ def create_agent_from_yaml(kernel, service_id, definition_file_path, reasoning_e
     
     return agent
 
-async def create_ai_foundry_agent_from_yaml(kernel, definition_file_path, reasoning_effort=None):
+async def create_ai_foundry_agent_from_yaml(kernel, definition_file_path, reasoning_effort=None, credential=None):
     """
     Creates a Azure AI Agent from a YAML definition file.
 
@@ -229,6 +244,7 @@ async def create_ai_foundry_agent_from_yaml(kernel, definition_file_path, reason
         kernel: The Semantic Kernel instance
         definition_file_path: Path to the YAML file containing agent definition
         reasoning_effort: Optional reasoning effort parameter for OpenAI models. Currently not yet supported by Azure AI Agent.
+        credential: Optional async credential to reuse. A new DefaultAzureCredential is created if omitted.
         
     Returns:
         AzureAIAgent: Configured agent instance
@@ -243,8 +259,8 @@ async def create_ai_foundry_agent_from_yaml(kernel, definition_file_path, reason
     project_connection_string = os.getenv("AI_PROJECT_CONNECTION_STRING")
     model_deployment_name = os.getenv("EXECUTOR_AZURE_OPENAI_DEPLOYMENT_NAME")
     
-    # Create credential
-    creds = DefaultAzureCredential()
+    # Reuse the caller's credential (and its token cache) when provided
+    creds = credential or DefaultAzureCredential()
     # Create client
     client = AzureAIAgent.create_client(credential=creds, conn_str=project_connection_string) 
     
@@ -271,39 +287,313 @@ async def create_ai_foundry_agent_from_yaml(kernel, definition_file_path, reason
     
     return agent
     
-async def describe_next_action(kernel, settings, messages):
+async def describe_turn(kernel, settings, message):
     """
-    Determines the next action in an agent conversation workflow.
+    Describes an agent turn - the next action and the CRITIC score - with a single call.
     
     Args:
         kernel: The Semantic Kernel instance
         settings: Execution settings for the prompt
-        messages: Conversation history between agents
+        message: The latest ChatMessageContent of the agent conversation
         
     Returns:
-        str: A three-word summary of the next action, indicating which agent should act
+        dict: "next_action" - a three-word summary of the next action, indicating which agent should act,
+              "score" - the evaluation score given by the CRITIC or None,
+              "parsed" - False when the reply was not valid JSON and next_action holds the raw reply
         
-    This function analyzes the conversation context to determine workflow progression
+    This function analyzes the latest agent message to determine workflow progression
     between WRITER and CRITIC agents, with special handling for high-scoring CRITIC responses.
     """
-    next_action = await kernel.invoke_prompt(
-        function_name="describe_next_action",
+    result = await kernel.invoke_prompt(
+        function_name="describe_turn",
         prompt=f"""
-        Provided the following chat history, what is next action in the agentic chat? 
+        Provided the following latest message of an agentic chat, what is next action in the chat
+        and what evaluation score did the CRITIC give?
         
-        Provide three word summary.
+        Respond with JSON only, for example: {{"next_action": "WRITER: Revises the draft", "score": 6}}
+        
+        next_action - three word summary.
         Always indicate WHO takes the action, for example: WRITER: Writes revises draft
         OBS! CRITIC cannot take action, only to evaluate the text and provide a score.
+        IF the message is from CRITIC and the score is above 8 - you MUST respond with "CRITIC: Approves the text."
         
-        IF the last entry is from CRITIC and the score is above 8 - you MUST respond with "CRITIC: Approves the text."
+        score - a single number only, for example - for 6/10 return 6. 
+        Use null if the message is not a CRITIC evaluation.
         
         AGENTS:
         - WRITER: Writes and revises the text
         - CRITIC: Evaluates the text and provides scroring from 1 to 10
         
-        AGENT_CHAT: {messages}
+        LATEST_MESSAGE: {message.name}: {message.content}
         
         """,
         settings=settings
     )
-    return next_action
\ No newline at end of file
+    
+    # Read the completion content rather than stringifying the whole FunctionResult
+    text = result.value[0].content if getattr(result, "value", None) else str(result)
+    try:
+        # Tolerate code fences or text around the JSON object
+        turn = json.loads(text[text.find("{"):text.rfind("}") + 1])
+        if not isinstance(turn, dict):
+            raise ValueError(f"Expected a JSON object, got {type(turn).__name__}")
+    except ValueError:
+        logging.exception("Could not parse turn description: %s", text)
+        return {"next_action": text, "score": None, "parsed": False}
+    return {"next_action": turn.get("next_action", ""), "score": turn.get("score"), "parsed": True}
+
+class TurnDescriber:
+    """
+    Describes every agent turn of one conversation exactly once.
+    
+    The termination strategy and the conversation loop both need the description of 
+    the same message. The first one to ask starts the utility call, the other one 
+    awaits the same task.
+    
+    A description only depends on the author and content of a message, so successfully 
+    parsed descriptions are also kept in a process-wide LRU cache shared by all conversations.
+    """
+    
+    cache_size = 512
+    _cache = OrderedDict()
+    
+    def __init__(self, kernel, settings):
+        self.kernel = kernel
+        self.settings = settings
+        self._turns = {}
+
+    def describe(self, message):
+        """
+        Returns the task describing the message, starting it on first request.
+        
+        Args:
+            message: ChatMessageContent from the agent chat history
+            
+        Returns:
+            asyncio.Task: Resolves to the describe_turn() result
+        """
+        key = id(message)
+        if key not in self._turns:
+            self._turns[key] = asyncio.create_task(self._describe(message))
+        return self._turns[key]
+
+    async def _describe(self, message):
+        """
+        Returns the cached description of the message or asks the utility model.
+        """
+        key = (message.name, hashlib.blake2b(str(message.content).encode(), digest_size=8).digest())
+        cache = TurnDescriber._cache
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        
+        turn = await describe_turn(self.kernel, self.settings, message)
+        # A malformed reply must not pin a bogus description for every later conversation
+        if not turn["parsed"]:
+            return turn
+        cache[key] = turn
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        return turn
+
+# --------------------------------------------
+# UTILITY - KEEPS a chat history within a token budget
+# --------------------------------------------
+class MemoryCompactor(ChatHistoryReducer):
+    """
+    Summarizes the middle of a chat history once it outgrows a token budget.
+    
+    The first message (the user request), the last message (the latest agent turn) and 
+    the turn it answers are always kept intact - the latest CRITIC feedback after a WRITER 
+    turn, the latest WRITER draft after a CRITIC turn. Everything else in between is replaced 
+    by a single "memory" system message produced by the utility model.
+    
+    Can be used directly through fit() or as the history_reducer of a 
+    KernelFunctionSelectionStrategy.
+    """
+    
+    kernel: Kernel
+    settings: PromptExecutionSettings
+    token_budget: int = Field(default=3000, gt=0)
+    target_count: int = Field(default=1, gt=0)
+    # The latest feedback of this agent is kept verbatim next to the summary - or, when 
+    # this agent spoke last, the latest message of the other agent
+    pinned_agent: str = Field(default="Critic")
+    
+    # Compacted history from the previous reduce() call and how many messages it covered
+    compacted: list[ChatMessageContent] = Field(default_factory=list)
+    seen_count: int = Field(default=0)
+
+    @staticmethod
+    def count_tokens(messages):
+        """
+        Estimates the number of tokens of the messages.
+        
+        Uses roughly four characters per token for English text plus a small 
+        per-message overhead - precise enough to decide when to compact.
+        """
+        return sum(len(str(m.content or "")) // 4 + 4 for m in messages)
+
+    async def fit(self, messages):
+        """
+        Returns the messages unchanged if they fit the token budget, otherwise a 
+        compacted copy: first message, memory summary, the turn the last message answers, last message.
+        
+        Args:
+            messages: List of ChatMessageContent. A "memory" message from a previous 
+                      compaction is folded into the new summary.
+        """
+        if len(messages) <= 2 or self.count_tokens(messages) <= self.token_budget:
+            return messages
+        
+        middle = messages[1:-1]
+        if messages[-1].name == self.pinned_agent:
+            # The CRITIC spoke last - keep the draft it reviewed
+            pinned = next((m for m in reversed(middle) 
+                           if m.role == AuthorRole.ASSISTANT and m.name != self.pinned_agent), None)
+        else:
+            pinned = next((m for m in reversed(middle) if m.name == self.pinned_agent), None)
+        middle = [m for m in middle if m is not pinned]
+        # Nothing new to summarize - an earlier memory alone is not summarized again
+        if all(m.name == "memory" for m in middle):
+            return messages
+        
+        summary = await self.kernel.invoke_prompt(
+            function_name="compact_memory",
+            prompt=f"""
+            Summarize the following part of a chat between a WRITER and a CRITIC agent.
+            
+            Keep the latest draft requirements, every CRITIC score and every open recommendation.
+            If the chat starts with an earlier memory summary, merge it into the new summary.
+            Do not exceed 10 sentences.
+            
+            AGENT_CHAT: {[m.to_dict() for m in middle]}
+            """,
+            settings=self.settings
+        )
+        content = summary.value[0].content if getattr(summary, "value", None) else str(summary)
+        
+        return [
+            messages[0],
+            ChatMessageContent(role=AuthorRole.SYSTEM, name="memory", content=content),
+            *([pinned] if pinned is not None else []),
+            messages[-1],
+        ]
+
+    async def reduce(self):
+        """
+        Compacts self.messages, returning None when no compaction was needed.
+        """
+        # The selection strategy hands over the full history on every turn.
+        # Histories only grow, so continue from the previous result instead of 
+        # summarizing the whole history again.
+        history = self.messages
+        if self.compacted and len(history) >= self.seen_count:
+            added = history[self.seen_count:]
+            history = self.compacted + added
+            # The compacted history is the new baseline - it can stay above the budget 
+            # when the kept turns are long. Summarizing again on every turn would put a
+            # utility call before every speaker selection, so wait until the turns added
+            # since the last compaction outgrow the budget on their own.
+            if self.count_tokens(added) <= self.token_budget:
+                self.messages = history
+                return self
+        
+        fitted = await self.fit(history)
+        if fitted is not history:
+            self.compacted = fitted
+            self.seen_count = len(self.messages)
+        
+        if fitted is self.messages:
+            return None
+        self.messages = fitted
+        return self
+
+# --------------------------------------------
+# UTILITY - ENDS the debate on the CRITIC score
+# --------------------------------------------
+# Critic evaluations state the score as "7/10" or "7 out of 10"
+_SCORE_RE = re.compile(r"(?<![\d./])(\d{1,2}(?:\.\d+)?)\s*(?:/|out\s+of)\s*10(?![\d/])", re.IGNORECASE)
+# Labels of the overall score, in order of preference - per-criterion scores carry other labels
+_SCORE_LABELS = (("overall", "final", "total"), ("score", "rating"))
+
+def parse_critic_score(evaluation):
+    """
+    Returns the overall score stated in a CRITIC evaluation.
+    
+    Evaluations often score single criteria next to the overall score, for example 
+    "Overall: 6/10 ... Ethics: 10/10". A score labelled "overall" wins over one labelled 
+    "score"; unlabelled scores are only used when they all agree.
+    
+    Args:
+        evaluation: The CRITIC message content
+        
+    Returns:
+        float: The overall score, or None when the evaluation has no unambiguous score
+    """
+    evaluation = evaluation or ""
+    scores = []
+    end = 0
+    for match in _SCORE_RE.finditer(evaluation):
+        # The label is the text leading to the score within its line, sentence or parenthesis
+        prefix = re.split(r"[\n.;(|]", evaluation[max(end, match.start() - 40):match.start()])[-1].lower()
+        scores.append((prefix, float(match.group(1))))
+        end = match.end()
+    
+    for labels in _SCORE_LABELS:
+        labelled = {score for prefix, score in scores if any(label in prefix for label in labels)}
+        if labelled:
+            return labelled.pop() if len(labelled) == 1 else None
+    
+    distinct = {score for _, score in scores}
+    return distinct.pop() if len(distinct) == 1 else None
+
+# Using UTILITY model through the TurnDescriber - the task is simple - evaluation score extraction
+class CompletionTerminationStrategy(TerminationStrategy):
+    """
+    Terminates the debate once the Critic's evaluation score reaches the threshold.
+    
+    The score is read from the evaluation text; the utility model's turn description
+    is only awaited when the evaluation has no unambiguous "N/10" score.
+    """
+    logger: ClassVar[logging.Logger] = logging.getLogger(__name__)
+    
+    turns: TurnDescriber
+    # 9 is a relatively high score. Set to 8 for stable result.
+    score_threshold: float = Field(default=8.0)
+    
+    iteration: int = Field(default=0)
+    # The most recent evaluation and its decision - identical evaluations are not re-scored
+    last_evaluation: str | None = Field(default=None)
+    last_should_terminate: bool = Field(default=False)
+
+    async def should_agent_terminate(self, agent, history):
+        """Terminate if the evaluation score >= the passing score."""
+        
+        self.iteration += 1
+        self.logger.info("Iteration: %s of %s", self.iteration, self.maximum_iterations)
+        
+        evaluation = history[-1].content
+        if evaluation == self.last_evaluation:
+            self.logger.info("Should terminate (cached): %s", self.last_should_terminate)
+            return self.last_should_terminate
+        
+        score = parse_critic_score(evaluation)
+        if score is None:
+            score = (await self.turns.describe(history[-1]))["score"]
+        self.logger.info("Critic Evaluation: %s", score)
+
+        if score is None:
+            # The message carries no evaluation
+            should_terminate = False
+        else:
+            try:
+                should_terminate = float(score) >= self.score_threshold
+            except (TypeError, ValueError):
+                self.logger.exception("Should terminate parse error")
+                should_terminate = False
+            
+        self.last_evaluation = evaluation
+        self.last_should_terminate = should_terminate
+        self.logger.info("Should terminate: %s", should_terminate)
+        return should_terminate
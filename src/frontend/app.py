@@ -117,15 +117,22 @@ with st.status("Agents are crafting a response...", expanded=True) as status:
         headers = {}
         
         # Processing treaming responses
-        # Each chunk can be be either a string or contain JSON. 
+        # "event: turn" marks a completed agent turn, "data: " carries the text of that turn as a JSON string.
+        # Any other chunk can be be either a string or contain JSON. 
         # If the chunk is a string it is a status action update - "Critic evaluates the text". 
         # If it is a JSON it will contain the generated blog post content.
+        draft_placeholder = status.empty()
+        draft = ""
         with requests.post(url, json=payload, headers={}, stream=True) as response:
             for line in response.iter_lines():
                 result = line.decode('utf-8')
-                # For each line as JSON
-                # result = json.loads(line.decode('utf-8'))
-                if not is_valid_json(result):
+                if result.startswith("event: turn"):
+                    draft = ""
+                elif result.startswith("data: "):
+                    # Show the text of the latest agent turn
+                    draft += json.loads(result[len("data: "):])
+                    draft_placeholder.markdown(draft)
+                elif not is_valid_json(result):
                    status.write(result)  
                    
         status.update(label="Backend call complete", state="complete", expanded=False)